@@ -0,0 +1,245 @@
+"""Benchmark the stages of ``update_country_ip.py`` on synthetic registry data.
+
+Delegated files in the RIR format are generated with a configurable number of
+records and IPv4/IPv6 mix, then run through each stage of the updater in
+turn, in this process and without the download or the parse worker pool, so
+every stage is timed on its own::
+
+    python scripts/bench_update.py --records 500000 --ipv6-share 0.3
+    python scripts/bench_update.py --save-baseline bench.json
+    python scripts/bench_update.py --baseline bench.json
+
+With ``--baseline`` the run exits with status 1 when a stage is slower than
+the stored one by more than ``--tolerance``. ``--generate DIR`` only writes
+the synthetic files, for use with ``update_country_ip.py --source DIR``.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import update_country_ip as updater
+
+STAGES = ("parse", "normalize", "aggregate", "sort", "render", "write")
+
+# Share of records a registry would skip: reserved/available space and ZZ
+SKIPPED_SHARE = 0.05
+
+IPV4_SIZES = (256, 256, 512, 768, 1024, 1024, 2048, 4096, 8192, 16384, 65536)
+IPV6_PREFIXES = (29, 32, 32, 32, 36, 40, 44, 48, 48)
+
+
+def registry_names():
+    return [url.rsplit("/", 1)[-1] for url in updater.URLS]
+
+
+def country_codes(rng, count=240):
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    codes = [a + b for a in letters for b in letters if a + b != "ZZ"]
+    return sorted(rng.sample(codes, count))
+
+
+def generate(directory, records, ipv6_share, seed=0):
+    # Registry files cover disjoint, ascending address space like the real
+    # ones, and a country often holds several adjacent blocks in a row so
+    # the aggregate stage has merging to do
+    rng = random.Random(seed)
+    codes = country_codes(rng)
+    names = registry_names()
+    directory.mkdir(parents=True, exist_ok=True)
+    cursor = {4: 1 << 24, 6: 0x2001 << 112}
+    per_file = records // len(names)
+
+    for n, name in enumerate(names):
+        registry = name.split("-")[1]
+        count = per_file if n < len(names) - 1 else records - per_file * (len(names) - 1)
+        lines = [
+            f"2|{registry}|20260101|{count}|19830101|20260101|+0000",
+            f"{registry}|*|ipv4|*|{count}|summary",
+            f"{registry}|*|ipv6|*|{count}|summary",
+        ]
+        cc = rng.choice(codes)
+        for _ in range(count):
+            if rng.random() > 0.6:
+                cc = rng.choice(codes)
+            status = "allocated" if rng.random() < 0.5 else "assigned"
+            if rng.random() < SKIPPED_SHARE:
+                status, cc = rng.choice((("reserved", ""), ("available", ""), ("assigned", "ZZ")))
+            if rng.random() < ipv6_share:
+                prefix = rng.choice(IPV6_PREFIXES)
+                size = 1 << (128 - prefix)
+                start = -(-cursor[6] // size) * size
+                if rng.random() < 0.3:
+                    start += size * rng.randrange(1, 64)
+                cursor[6] = start + size
+                address = socket.inet_ntop(socket.AF_INET6, start.to_bytes(16, "big"))
+                lines.append(f"{registry}|{cc}|ipv6|{address}|{prefix}|20100101|{status}")
+            else:
+                size = rng.choice(IPV4_SIZES)
+                start = cursor[4]
+                if rng.random() < 0.3:
+                    start += 256 * rng.randrange(1, 256)
+                if start + size > 0xE0000000:
+                    start = 1 << 24
+                cursor[4] = start + size
+                address = socket.inet_ntoa(start.to_bytes(4, "big"))
+                lines.append(f"{registry}|{cc}|ipv4|{address}|{size}|20100101|{status}")
+            if status in ("reserved", "available"):
+                cc = rng.choice(codes)
+        (directory / name).write_text("\n".join(lines) + "\n")
+    return [directory / name for name in names]
+
+
+def peak_rss():
+    # Peak resident set size of this process so far, in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_stages(paths, out_dir):
+    # One pass through the pipeline, returning seconds per stage. Writes go
+    # to a fresh directory so every file is written in full.
+    timings = {}
+
+    def timed(stage, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings[stage] = time.perf_counter() - started
+        return result
+
+    def parse_all():
+        parsed = []
+        for path in paths:
+            with updater.open_registry_file(path) as f:
+                parsed.append(updater.parse(line.rstrip("\r\n") for line in f))
+        return parsed
+
+    def normalize(parsed):
+        countries = defaultdict(updater.new_columns)
+        for packed in map(updater.pack, parsed):
+            for cc, columns in packed.items():
+                for merged, column in zip(countries[cc], columns):
+                    merged.extend(column)
+        return countries
+
+    def write(aggregated, cidrs, flat):
+        updater.write_delta({}, cidrs)
+        updater.write(cidrs)
+        updater.write_nftables(aggregated)
+        updater.write_ipset(cidrs)
+        updater.write_iptables(cidrs)
+        updater.write_snapshot(flat, updater.SNAPSHOT_PATH)
+        updater.write_mmdb(flat, updater.MMDB_PATH)
+        updater.write_nginx_geo(flat, updater.NGINX_GEO_PATH)
+        updater.write_haproxy_map(flat, updater.HAPROXY_MAP_PATH)
+
+    parsed = timed("parse", parse_all)
+    countries = timed("normalize", normalize, parsed)
+    aggregated = timed("aggregate", updater.aggregate, countries)
+    # The cross-country sort into disjoint ranges; per-country sorting is
+    # part of aggregate
+    flat = timed("sort", updater.flatten, aggregated)
+    cidrs = timed("render", updater.render_cidrs, aggregated)
+
+    cwd = os.getcwd()
+    out_dir.mkdir(parents=True)
+    os.chdir(out_dir)
+    try:
+        timed("write", write, aggregated, cidrs, flat)
+    finally:
+        os.chdir(cwd)
+    return timings
+
+
+def compare(result, baseline, tolerance):
+    # Print each stage against the baseline; returns the stages that regressed
+    if (baseline["records"], baseline["ipv6_share"]) != (result["records"], result["ipv6_share"]):
+        print(
+            f"Warning: baseline was taken with {baseline['records']} records and IPv6 share "
+            f"{baseline['ipv6_share']}, timings are not comparable"
+        )
+    slower = []
+    for stage in STAGES:
+        seconds, before = result["stages"][stage], baseline["stages"].get(stage)
+        if not before:
+            continue
+        change = seconds / before - 1
+        flag = ""
+        if change > tolerance:
+            slower.append(stage)
+            flag = "  SLOWER"
+        print(f"{stage:>10}: {seconds:8.3f}s vs {before:8.3f}s  {change:+7.1%}{flag}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark update_country_ip.py stages on synthetic registry files.")
+    parser.add_argument("--records", type=int, default=200_000, help="records across all registries (default: 200000)")
+    parser.add_argument("--ipv6-share", type=float, default=0.3, help="share of records that are IPv6 (default: 0.3)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the generated files (default: 0)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is kept (default: 3)")
+    parser.add_argument("--generate", type=Path, metavar="DIR", help="only write the synthetic registry files to DIR")
+    parser.add_argument("--baseline", type=Path, help="compare against timings saved with --save-baseline")
+    parser.add_argument("--save-baseline", type=Path, help="save this run's timings as a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="slowdown against the baseline tolerated before failing (default: 0.2, i.e. 20%%)",
+    )
+    args = parser.parse_args()
+    if args.records < 1:
+        parser.error("--records must be at least 1")
+    if not 0 <= args.ipv6_share <= 1:
+        parser.error("--ipv6-share must be between 0 and 1")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    if args.generate:
+        generate(args.generate, args.records, args.ipv6_share, args.seed)
+        print(f"Wrote {args.records} records to {args.generate}")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        paths = generate(tmp / "registries", args.records, args.ipv6_share, args.seed)
+        size = sum(path.stat().st_size for path in paths)
+        print(f"Generated {args.records} records ({size / 1e6:.1f} MB), IPv6 share {args.ipv6_share}")
+
+        best = {}
+        for run in range(args.repeat):
+            for stage, seconds in run_stages(paths, tmp / f"out{run}").items():
+                best[stage] = min(seconds, best.get(stage, seconds))
+
+    result = {
+        "records": args.records,
+        "ipv6_share": args.ipv6_share,
+        "stages": best,
+        "peak_rss": peak_rss(),
+    }
+    for stage in STAGES:
+        print(f"{stage:>10}: {best[stage]:8.3f}s  {args.records / best[stage]:>12,.0f} records/s")
+    print(f"{'total':>10}: {sum(best.values()):8.3f}s")
+    print(f"Peak RSS: {result['peak_rss'] / 2**20:.1f} MiB")
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(result, indent=2) + "\n")
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        slower = compare(result, json.loads(args.baseline.read_text()), args.tolerance)
+        if slower:
+            print(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(slower)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
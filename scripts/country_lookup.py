@@ -0,0 +1,433 @@
+"""Look up the country an IP address is registered to.
+
+Ranges are loaded either from the per-country lists in ``country/`` or from
+the binary snapshot ``db/country-ip-blocks.bin`` written by
+``update_country_ip.py``, and single addresses are answered with a binary
+search over the sorted start addresses::
+
+    from country_lookup import lookup
+    lookup("1.0.16.1")      # -> "JP"
+
+Run ``python scripts/country_lookup.py --bench`` for a lookups-per-second
+micro-benchmark.
+"""
+
+import argparse
+import bisect
+import heapq
+import ipaddress
+import mmap
+import random
+import socket
+import struct
+import sys
+import time
+import warnings
+from array import array
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:  # only needed for the batch lookups
+    np = None
+
+ROOT = Path(__file__).resolve().parent.parent
+COUNTRY_DIR = ROOT / "country"
+SNAPSHOT_PATH = ROOT / "db" / "country-ip-blocks.bin"
+
+# Binary snapshot written by update_country_ip.py. Little-endian, every
+# section starts on an 8-byte boundary:
+#   header         magic, format version, country index width in bytes,
+#                  country count, IPv4 range count, IPv6 range count, reserved
+#   country codes  2 ASCII bytes per country; the country index points here
+#   IPv4           start uint32[], end uint32[], country index[]
+#   IPv6           start high uint64[], start low uint64[],
+#                  end high uint64[], end low uint64[], country index[]
+# Ranges are sorted by start, do not overlap and ends are inclusive.
+SNAPSHOT_MAGIC = b"CIPB"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHHIIII")
+
+INDEX_TYPES = {1: "B", 2: "H"}
+
+LOW_64 = (1 << 64) - 1
+
+
+def parse_address(ip):
+    """Return ``(version, integer)`` for an address string or ipaddress object."""
+    if isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        return ip.version, int(ip)
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+    except OSError:
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+    except OSError:
+        raise ValueError(f"invalid IP address: {ip!r}") from None
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("batch lookups require numpy (pip install numpy)")
+
+
+def ipv4_array(addresses):
+    """Convert IPv4 addresses, as integers or dotted-quad strings, to a ``uint32`` array.
+
+    Strings are parsed in one pass by NumPy rather than one Python call per
+    address.
+    """
+    require_numpy()
+    values = np.asarray(addresses)
+    if values.size == 0:
+        return np.zeros(0, dtype=np.uint32)
+    if values.dtype.kind in "iu":
+        if values.min() < 0 or values.max() > 0xFFFFFFFF:
+            raise ValueError("integer IPv4 addresses must be between 0 and 2**32 - 1")
+        return values.astype(np.uint32).ravel()
+
+    values = values.astype(str).ravel()
+    # Only digits and exactly three dots, so signs, spaces and newlines that
+    # NumPy's parser would skip are rejected as inet_pton rejects them
+    if not (np.char.count(values, ".") == 3).all() or not np.char.isdigit(np.char.replace(values, ".", "")).all():
+        raise ValueError("batch contains an invalid IPv4 address")
+    try:
+        with warnings.catch_warnings():
+            # NumPy reports unparsable text as a DeprecationWarning
+            warnings.simplefilter("error", DeprecationWarning)
+            octets = np.fromstring(".".join(values.tolist()), dtype=np.int64, sep=".")
+    except (ValueError, DeprecationWarning):
+        raise ValueError("batch contains an invalid IPv4 address") from None
+    if octets.size != 4 * values.size or ((octets < 0) | (octets > 255)).any():
+        raise ValueError("batch contains an invalid IPv4 address")
+    octets = octets.astype(np.uint32).reshape(-1, 4)
+    # Leading zeros ("01.2.3.4") make a string longer than its octets written out
+    digits = 1 + (octets >= 10) + (octets >= 100)
+    if (np.char.str_len(values) != 3 + digits.sum(axis=1)).any():
+        raise ValueError("batch contains an invalid IPv4 address")
+    return (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+
+
+def ipv6_dtype():
+    # 128-bit values as a (high, low) pair; structured arrays compare lexicographically
+    return np.dtype([("high", np.uint64), ("low", np.uint64)])
+
+
+def ipv6_array(addresses):
+    """Convert IPv6 addresses to a structured ``(high, low)`` ``uint64`` array.
+
+    Accepts a structured array with ``high``/``low`` fields, an ``(n, 2)``
+    integer array of ``(high, low)`` pairs, packed 16-byte network-order
+    values (``S16``), or address strings. Strings go through ``inet_pton``
+    one by one, so pass one of the numeric forms for the highest throughput.
+    """
+    require_numpy()
+    dtype = ipv6_dtype()
+    values = np.asarray(addresses)
+    if values.size == 0:
+        return np.zeros(0, dtype=dtype)
+    if values.dtype.names:
+        return values.astype(dtype).ravel()
+    if values.dtype.kind in "iu" and values.ndim == 2 and values.shape[1] == 2:
+        pairs = values.astype(np.uint64)
+    elif values.dtype.kind in "SV" and values.dtype.itemsize == 16:
+        pairs = np.frombuffer(values.tobytes(), dtype=">u8").reshape(-1, 2)
+    else:
+        try:
+            packed = b"".join(socket.inet_pton(socket.AF_INET6, address) for address in values.astype(str).ravel())
+        except OSError:
+            raise ValueError("batch contains an invalid IPv6 address") from None
+        pairs = np.frombuffer(packed, dtype=">u8").reshape(-1, 2)
+    result = np.empty(len(pairs), dtype=dtype)
+    result["high"] = pairs[:, 0]
+    result["low"] = pairs[:, 1]
+    return result
+
+
+def disjoint_ranges(ranges):
+    """Flatten ``(start, end, index)`` triples with inclusive ends into sorted,
+    non-overlapping ranges.
+
+    Registries occasionally list the same addresses under two countries; where
+    ranges overlap the narrower one wins, as in a longest-prefix match.
+    Directly adjacent ranges of the same country are joined.
+    """
+    ranges = sorted(ranges)
+    flat = []
+    active = []  # heap of (size, end, index) for ranges covering pos
+    i = 0
+    pos = None
+    while True:
+        while active and active[0][1] < pos:
+            heapq.heappop(active)
+        if not active:
+            if i == len(ranges):
+                break
+            pos = ranges[i][0]
+        while i < len(ranges) and ranges[i][0] <= pos:
+            start, end, index = ranges[i]
+            i += 1
+            if end >= pos:
+                heapq.heappush(active, (end - start, end, index))
+        if not active:
+            continue
+
+        _, end, index = active[0]
+        if i < len(ranges):
+            end = min(end, ranges[i][0] - 1)
+        if flat and flat[-1][2] == index and flat[-1][1] + 1 == pos:
+            flat[-1][1] = end
+        else:
+            flat.append([pos, end, index])
+        pos = end + 1
+    return flat
+
+
+class CountryLookup:
+    """Sorted, inclusive integer ranges per address family with their countries."""
+
+    def __init__(self, codes, ipv4, ipv6):
+        # ipv4 is (starts, ends, country indexes) and ipv6 is (start high,
+        # start low, end high, end low, country indexes), columns sorted by
+        # start; arrays or memoryviews over a mapped snapshot
+        self.codes = codes
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+        self._ipv6_batch = None
+
+    @classmethod
+    def from_ranges(cls, codes, ipv4, ipv6):
+        """Build from ``(start, end, country index)`` triples with inclusive ends."""
+        index_type = "B" if len(codes) <= 256 else "H"
+        v4 = disjoint_ranges(ipv4)
+        v6 = disjoint_ranges(ipv6)
+        return cls(
+            codes,
+            (array("I", (r[0] for r in v4)), array("I", (r[1] for r in v4)), array(index_type, (r[2] for r in v4))),
+            (
+                array("Q", (r[0] >> 64 for r in v6)),
+                array("Q", (r[0] & LOW_64 for r in v6)),
+                array("Q", (r[1] >> 64 for r in v6)),
+                array("Q", (r[1] & LOW_64 for r in v6)),
+                array(index_type, (r[2] for r in v6)),
+            ),
+        )
+
+    @classmethod
+    def from_directory(cls, path=COUNTRY_DIR):
+        """Load the ``<cc>.txt`` CIDR lists in ``path``."""
+        codes = []
+        ranges = {4: [], 6: []}
+        for index, file in enumerate(sorted(Path(path).glob("*.txt"))):
+            codes.append(file.stem.upper())
+            with open(file) as f:
+                for line in f:
+                    address, _, prefix = line.strip().partition("/")
+                    if not address:
+                        continue
+                    version, start = parse_address(address)
+                    bits = 32 if version == 4 else 128
+                    end = start + (1 << (bits - int(prefix or bits))) - 1
+                    # Rejoin the CIDR blocks of each listed range so overlaps
+                    # between countries resolve the same way as in the snapshot
+                    family = ranges[version]
+                    if family and family[-1][2] == index and family[-1][1] + 1 == start:
+                        family[-1][1] = end
+                    else:
+                        family.append([start, end, index])
+        return cls.from_ranges(codes, ranges[4], ranges[6])
+
+    @classmethod
+    def from_snapshot(cls, path=SNAPSHOT_PATH):
+        """Map a binary snapshot written by ``update_country_ip.py``.
+
+        The columns are memoryviews straight over the mapped file, so nothing
+        is parsed or copied on a little-endian machine.
+        """
+        with open(path, "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, version, width, code_count, v4_count, v6_count, _ = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or width not in INDEX_TYPES:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} country IP snapshot")
+
+        offset = SNAPSHOT_HEADER.size
+
+        def section(size):
+            nonlocal offset
+            chunk = data[offset:offset + size]
+            offset += size + (-size % 8)
+            return chunk
+
+        def column(typecode, count):
+            chunk = section(count * array(typecode).itemsize)
+            if sys.byteorder == "little":
+                return chunk.cast(typecode)
+            values = array(typecode, chunk)
+            values.byteswap()
+            return values
+
+        raw_codes = bytes(section(2 * code_count)).decode("ascii")
+        codes = [raw_codes[i:i + 2] for i in range(0, len(raw_codes), 2)]
+        index_type = INDEX_TYPES[width]
+
+        ipv4 = column("I", v4_count), column("I", v4_count), column(index_type, v4_count)
+        ipv6 = tuple(column("Q", v6_count) for _ in range(4)) + (column(index_type, v6_count),)
+        return cls(codes, ipv4, ipv6)
+
+    def country_array(self):
+        # Country codes plus a trailing "" that misses map to
+        return np.array(self.codes + [""])
+
+    def lookup_ipv4_batch(self, addresses):
+        """Look up many IPv4 addresses at once with ``numpy.searchsorted``.
+
+        ``addresses`` is any array-like of integers or dotted-quad strings.
+        Returns an array of country codes, with ``""`` for addresses that are
+        not in any range.
+        """
+        values = ipv4_array(addresses)
+        starts, ends, indexes = (np.asarray(memoryview(column)) for column in self.ipv4)
+        found = np.full(values.shape, len(self.codes))
+        if len(starts):
+            i = np.searchsorted(starts, values, side="right") - 1
+            hit = i >= 0
+            i[~hit] = 0
+            hit &= values <= ends[i]
+            found[hit] = indexes[i[hit]]
+        return self.country_array()[found]
+
+    def ipv6_batch_columns(self):
+        # Structured (high, low) start and end columns, built on first use
+        if self._ipv6_batch is None:
+            start_high, start_low, end_high, end_low, indexes = (np.asarray(memoryview(column)) for column in self.ipv6)
+            starts = np.empty(len(start_high), dtype=ipv6_dtype())
+            starts["high"], starts["low"] = start_high, start_low
+            ends = np.empty(len(end_high), dtype=ipv6_dtype())
+            ends["high"], ends["low"] = end_high, end_low
+            self._ipv6_batch = starts, ends, indexes
+        return self._ipv6_batch
+
+    def lookup_ipv6_batch(self, addresses):
+        """Look up many IPv6 addresses at once over split 64-bit keys.
+
+        ``addresses`` is anything ``ipv6_array`` accepts. Returns an array of
+        country codes, with ``""`` for addresses that are not in any range.
+        """
+        values = ipv6_array(addresses)
+        starts, ends, indexes = self.ipv6_batch_columns()
+        found = np.full(values.shape, len(self.codes))
+        if len(starts):
+            # Search on the high word alone, then redo the few queries that
+            # share their high word with the candidate range on both words
+            i = np.searchsorted(starts["high"], values["high"], side="right") - 1
+            hit = i >= 0
+            i[~hit] = 0
+            tie = hit & (starts["high"][i] == values["high"]) & (starts["low"][i] > values["low"])
+            if tie.any():
+                i[tie] = np.searchsorted(starts, values[tie], side="right") - 1
+                hit[tie] = i[tie] >= 0
+                i[~hit] = 0
+            end = ends[i]
+            hit &= (end["high"] > values["high"]) | ((end["high"] == values["high"]) & (end["low"] >= values["low"]))
+            found[hit] = indexes[i[hit]]
+        return self.country_array()[found]
+
+    def lookup(self, ip):
+        """Return the country code for ``ip``, or ``None`` if no range covers it."""
+        version, value = parse_address(ip)
+        if version == 4:
+            starts, ends, indexes = self.ipv4
+            i = bisect.bisect_right(starts, value) - 1
+            if i >= 0 and value <= ends[i]:
+                return self.codes[indexes[i]]
+            return None
+
+        # Ranges sharing the address's high word are sorted by their low word,
+        # and the one before them is the last range with a lower high word
+        start_high, start_low, end_high, end_low, indexes = self.ipv6
+        high, low = value >> 64, value & LOW_64
+        first = bisect.bisect_left(start_high, high)
+        i = bisect.bisect_right(start_low, low, first, bisect.bisect_right(start_high, high, first)) - 1
+        if i >= 0 and (high, low) <= (end_high[i], end_low[i]):
+            return self.codes[indexes[i]]
+        return None
+
+
+def load(path=None):
+    """Load a snapshot file or a country directory, preferring the snapshot."""
+    if path is None:
+        path = SNAPSHOT_PATH if SNAPSHOT_PATH.exists() else COUNTRY_DIR
+    path = Path(path)
+    if path.is_dir():
+        return CountryLookup.from_directory(path)
+    return CountryLookup.from_snapshot(path)
+
+
+_default = None
+
+
+def lookup(ip):
+    """Look up ``ip`` in the data shipped with this repository."""
+    global _default
+    if _default is None:
+        _default = load()
+    return _default.lookup(ip)
+
+
+def benchmark(table, count, seed=0):
+    # Random addresses, so most queries land outside the listed ranges just
+    # like real traffic would not; the bisect cost is the same either way
+    rng = random.Random(seed)
+    samples = {
+        "ipv4": [socket.inet_ntoa(rng.getrandbits(32).to_bytes(4, "big")) for _ in range(count)],
+        "ipv6": [
+            socket.inet_ntop(socket.AF_INET6, ((1 << 125) | rng.getrandbits(125)).to_bytes(16, "big"))
+            for _ in range(count)
+        ],
+    }
+    results = {}
+    for family, addresses in samples.items():
+        started = time.perf_counter()
+        for address in addresses:
+            table.lookup(address)
+        results[family] = count / (time.perf_counter() - started)
+
+    if np is not None:
+        batches = (
+            ("ipv4 batch, strings", table.lookup_ipv4_batch, samples["ipv4"]),
+            ("ipv4 batch, integers", table.lookup_ipv4_batch, ipv4_array(samples["ipv4"])),
+            ("ipv6 batch, strings", table.lookup_ipv6_batch, samples["ipv6"]),
+            ("ipv6 batch, (high, low)", table.lookup_ipv6_batch, ipv6_array(samples["ipv6"])),
+        )
+        table.ipv6_batch_columns()
+        for family, lookup_batch, batch in batches:
+            started = time.perf_counter()
+            lookup_batch(batch)
+            results[family] = count / (time.perf_counter() - started)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up the country of IP addresses.")
+    parser.add_argument("addresses", nargs="*", help="IPv4 or IPv6 addresses to look up")
+    parser.add_argument("--source", type=Path, help="snapshot file or country directory (default: snapshot if present)")
+    parser.add_argument("--bench", action="store_true", help="measure lookups per second on random addresses")
+    parser.add_argument("--count", type=int, default=200_000, help="addresses per family for --bench (default: 200000)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    table = load(args.source)
+    loaded = time.perf_counter() - started
+
+    for address in args.addresses:
+        print(f"{address}\t{table.lookup(address) or '-'}")
+
+    if args.bench:
+        print(f"Loaded {len(table.ipv4[0])} IPv4 and {len(table.ipv6[0])} IPv6 ranges in {loaded:.3f}s")
+        for family, rate in benchmark(table, args.count).items():
+            print(f"{family}: {rate:,.0f} lookups/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+#!/bin/sh
+# Atomically refresh ipset sets from the restore files in ipset/.
+#
+#   scripts/ipset-refresh.sh us_v4 us_v6 cn_v4
+#
+# Each file builds <name>-new in one `ipset restore` call, which is then
+# swapped with the live set so rules referencing <name> never see it empty.
+set -eu
+
+dir="$(dirname "$0")/../ipset"
+
+for name in "$@"; do
+    ipset destroy "$name-new" 2>/dev/null || true
+    ipset restore < "$dir/$name.restore"
+    if ipset list -n "$name" >/dev/null 2>&1; then
+        ipset swap "$name-new" "$name"
+        ipset destroy "$name-new"
+    else
+        ipset rename "$name-new" "$name"
+    fi
+done
@@ -0,0 +1,208 @@
+"""Minimal writer for the MaxMind DB (``.mmdb``) format.
+
+Only what the country database needs is implemented: an IPv6 search tree
+with IPv4 stored at ``::/96``, a deduplicated data section and the metadata
+block. See https://maxmind.github.io/MaxMind-DB/ for the format itself.
+"""
+
+import bisect
+import struct
+import time
+from array import array
+
+METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+DATA_SECTION_SEPARATOR = b"\0" * 16
+
+# Data section type numbers
+POINTER, UTF8_STRING, DOUBLE, BYTES, UINT16, UINT32, MAP, INT32, UINT64, UINT128, ARRAY = range(1, 12)
+BOOLEAN = 14
+
+
+class UInt16(int):
+    type = UINT16
+
+
+class UInt32(int):
+    type = UINT32
+
+
+class UInt64(int):
+    type = UINT64
+
+
+def control(type_id, size):
+    if size < 29:
+        first, extra = size, b""
+    elif size < 285:
+        first, extra = 29, bytes([size - 29])
+    elif size < 65821:
+        first, extra = 30, (size - 285).to_bytes(2, "big")
+    else:
+        first, extra = 31, (size - 65821).to_bytes(3, "big")
+    if type_id <= 7:
+        return bytes([type_id << 5 | first]) + extra
+    # Extended types put the type in the byte after the control byte
+    return bytes([first, type_id - 7]) + extra
+
+
+def encode(value):
+    """Encode a Python value as a data section field."""
+    if isinstance(value, str):
+        payload = value.encode("utf-8")
+        return control(UTF8_STRING, len(payload)) + payload
+    if isinstance(value, dict):
+        fields = b"".join(encode(key) + encode(item) for key, item in value.items())
+        return control(MAP, len(value)) + fields
+    if isinstance(value, (list, tuple)):
+        return control(ARRAY, len(value)) + b"".join(encode(item) for item in value)
+    if isinstance(value, bool):
+        return control(BOOLEAN, int(value))
+    if isinstance(value, int):
+        if value < 0:
+            raise ValueError("only unsigned integers are supported")
+        type_id = getattr(value, "type", UINT32 if value < 1 << 32 else UINT64)
+        payload = value.to_bytes((value.bit_length() + 7) // 8, "big")
+        return control(type_id, len(payload)) + payload
+    if isinstance(value, float):
+        return control(DOUBLE, 8) + struct.pack(">d", value)
+    raise TypeError(f"cannot encode {type(value).__name__} in a MaxMind DB")
+
+
+class MMDBWriter:
+    """Builds an IPv6 MaxMind DB in memory.
+
+    Networks are inserted with ``insert``; a network overrides any less
+    specific one inserted before it, so insert from the least to the most
+    specific when they overlap. ``insert_ranges`` builds the whole tree from
+    sorted ranges in one pass, which is much faster for large data sets.
+    """
+
+    def __init__(self, database_type, description, languages=("en",)):
+        self.database_type = database_type
+        self.description = description
+        self.languages = list(languages)
+        # Two records per node. 0 is an empty record (no node ever points
+        # back at the root), positive values are node numbers and negative
+        # values are -(data offset + 1).
+        self.left = array("q", [0])
+        self.right = array("q", [0])
+        self.data = bytearray()
+        self.data_offsets = {}
+
+    def store(self, value):
+        encoded = encode(value)
+        offset = self.data_offsets.get(encoded)
+        if offset is None:
+            offset = self.data_offsets[encoded] = len(self.data)
+            self.data += encoded
+        return offset
+
+    def walk(self, network, depth):
+        # Return the node at the given depth along network's bits, creating
+        # nodes as needed; a leaf met on the way is pushed down to both children
+        node = 0
+        for bit in range(depth):
+            records = self.right if network >> (127 - bit) & 1 else self.left
+            child = records[node]
+            if child <= 0:
+                self.left.append(child)
+                self.right.append(child)
+                child = records[node] = len(self.left) - 1
+            node = child
+        return node
+
+    def insert(self, version, network, prefix, value):
+        """Map ``network/prefix`` (IPv4 or IPv6, as integers) to ``value``."""
+        if version == 4:
+            prefix += 96
+        if not 0 < prefix <= 128:
+            raise ValueError(f"invalid prefix length {prefix}")
+        node = self.walk(network, prefix - 1)
+        records = self.right if network >> (128 - prefix) & 1 else self.left
+        records[node] = -(self.store(value) + 1)
+
+    def insert_ranges(self, ranges):
+        """Fill an empty tree from ``(start, end, value)`` ranges.
+
+        Starts and inclusive ends are 128-bit integers, with IPv4 addresses
+        at ``::/96``; ranges must be sorted and must not overlap. Each node is
+        created once, top down, instead of walking from the root per network.
+        """
+        if len(self.left) != 1 or self.left[0] or self.right[0]:
+            raise ValueError("insert_ranges needs an empty tree")
+        starts = [start for start, _, _ in ranges]
+        ends = [end for _, end, _ in ranges]
+        offsets = [self.store(value) for _, _, value in ranges]
+
+        def fill(node, lo, hi, span_start, bits):
+            # ranges[lo:hi] all intersect the node's span; the last one left
+            # of the midpoint can reach into the right half as well
+            mid = span_start + (1 << (bits - 1))
+            cut = bisect.bisect_left(starts, mid, lo, hi)
+            right_lo = cut - 1 if cut > lo and ends[cut - 1] >= mid else cut
+            self.left[node] = record(lo, cut, span_start, bits - 1)
+            self.right[node] = record(right_lo, hi, mid, bits - 1)
+
+        def record(lo, hi, span_start, bits):
+            if lo == hi:
+                return 0
+            if hi - lo == 1 and starts[lo] <= span_start and ends[lo] >= span_start + (1 << bits) - 1:
+                return -(offsets[lo] + 1)
+            self.left.append(0)
+            self.right.append(0)
+            node = len(self.left) - 1
+            fill(node, lo, hi, span_start, bits)
+            return node
+
+        if ranges:
+            fill(0, 0, len(ranges), 0, 128)
+
+    def alias(self, network, prefix, target):
+        # Point network/prefix at an existing node, unless data already lives there
+        node = self.walk(network, prefix - 1)
+        records = self.right if network >> (128 - prefix) & 1 else self.left
+        if records[node] == 0:
+            records[node] = target
+
+    def add_ipv4_aliases(self):
+        # Make IPv4-mapped (::ffff:0:0/96) and 6to4 (2002::/16) addresses
+        # resolve through the IPv4 subtree, as MaxMind's own databases do
+        ipv4_root = self.walk(0, 96)
+        self.alias(0xFFFF << 32, 96, ipv4_root)
+        self.alias(0x2002 << 112, 16, ipv4_root)
+
+    def to_bytes(self, build_epoch=None):
+        node_count = len(self.left)
+        largest = node_count + len(DATA_SECTION_SEPARATOR) + len(self.data)
+        record_size = next(size for size in (24, 28, 32) if largest < 1 << size)
+
+        def resolve(record):
+            if record > 0:
+                return record
+            if record == 0:
+                return node_count
+            return node_count + len(DATA_SECTION_SEPARATOR) - record - 1
+
+        tree = bytearray()
+        for left, right in zip(self.left, self.right):
+            left, right = resolve(left), resolve(right)
+            if record_size == 24:
+                tree += left.to_bytes(3, "big") + right.to_bytes(3, "big")
+            elif record_size == 28:
+                middle = (left >> 24) << 4 | right >> 24
+                tree += (left & 0xFFFFFF).to_bytes(3, "big") + bytes([middle]) + (right & 0xFFFFFF).to_bytes(3, "big")
+            else:
+                tree += left.to_bytes(4, "big") + right.to_bytes(4, "big")
+
+        metadata = {
+            "binary_format_major_version": UInt16(2),
+            "binary_format_minor_version": UInt16(0),
+            "build_epoch": UInt64(int(time.time()) if build_epoch is None else build_epoch),
+            "database_type": self.database_type,
+            "description": self.description,
+            "ip_version": UInt16(6),
+            "languages": self.languages,
+            "node_count": UInt32(node_count),
+            "record_size": UInt16(record_size),
+        }
+        return bytes(tree) + DATA_SECTION_SEPARATOR + bytes(self.data) + METADATA_MARKER + encode(metadata)
@@ -1,7 +1,26 @@
+import argparse
+import bz2
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import tracemalloc
 import requests
 import ipaddress
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from country_lookup import SNAPSHOT_HEADER, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, disjoint_ranges
+from mmdb_writer import METADATA_MARKER, MMDBWriter
 
 URLS = [
     "https://ftp.arin.net/pub/stats/arin/delegated-arin-extended-latest",
@@ -12,56 +31,972 @@ URLS = [
 ]
 
 OUT_DIR = Path("country")
-OUT_DIR.mkdir(exist_ok=True)
+IPV4_DIR = Path("ipv4")
+IPV6_DIR = Path("ipv6")
+
+# Changes against the previous run's country/ lists
+DELTA_DIR = Path("delta")
+
+# nftables interval sets, one file per country, all in one inet table
+NFT_DIR = Path("nftables")
+NFT_TABLE = "country_ip_blocks"
+
+# ipset restore files, one per country and family
+IPSET_DIR = Path("ipset")
+
+# nginx geo block that sets $country for every client address
+NGINX_GEO_PATH = Path("nginx/geo.conf")
+
+# iptables-restore rule files, one chain per country
+IPTABLES_DIR = Path("iptables")
+IPTABLES_CHAIN_PREFIX = "COUNTRY-"
+IPTABLES_TARGET = "DROP"
+
+# HAProxy map file for map_ip
+HAPROXY_MAP_PATH = Path("haproxy/country.map")
+
+# Binary snapshot of every range for memory-mapped lookups; the format is
+# described in country_lookup.py
+SNAPSHOT_PATH = Path("db/country-ip-blocks.bin")
+
+# MaxMind DB with the same data; the database type lets GeoIP2 readers open
+# it as a country database
+MMDB_PATH = Path("db/country-ip-blocks.mmdb")
+MMDB_DATABASE_TYPE = "GeoLite2-Country"
+
+# Bytes read from the socket at a time while streaming a registry file
+CHUNK_SIZE = 64 * 1024
+
+# Raw delegated files and their HTTP validators from the previous run
+CACHE_DIR = Path(".cache/rir")
+
+# Compressed registry files are recognised by their leading bytes, so the
+# same code reads plain, gzip and bzip2 input from disk or a mirror
+COMPRESSED_FORMATS = ((b"\x1f\x8b", gzip.open), (b"BZh", bz2.open))
+COMPRESSED_SUFFIXES = (".gz", ".bz2")
+
+# Address width per IP version, used to size blocks from their prefix length
+ADDRESS_BITS = {4: 32, 6: 128}
+
+# Per-stage timings and sizes for the run report
+REPORT_PATH = Path(".cache/update-report.json")
+
+# Output files rewritten vs. left untouched because their content was
+# unchanged, and the bytes written
+file_writes = Counter()
+
+# Filled in by stage() and written out as the run report
+stages = {}
+
+# Download and parse figures per registry, for the report and metrics
+registries = {}
+
+# CIDR blocks per country and family from this run, for the metrics
+country_blocks = {}
+
+# node_exporter textfile collector metrics, all named <prefix>_*
+METRICS_PREFIX = "country_ip_blocks"
+
+# One connection per registry is enough to fetch everything in parallel.
+DEFAULT_CONCURRENCY = len(URLS)
+
+# Registry files are parsed in worker processes, one file per worker
+DEFAULT_JOBS = min(len(URLS), os.cpu_count() or 1)
+
+# Workers are started on the first submit, from a download thread. Forking
+# there would copy a process whose other threads may hold locks (SSL, stdout),
+# so they come from a fork server, or are spawned where there is none.
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+LOW_64 = (1 << 64) - 1
+
+
+def make_session(concurrency):
+    # Shared session so all workers draw from a single connection pool
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def cache_paths(cache_dir, url):
+    name = url.rsplit("/", 1)[-1]
+    return cache_dir / name, cache_dir / f"{name}.json"
+
+
+def load_validators(cache_dir, url):
+    raw_path, meta_path = cache_paths(cache_dir, url)
+    if not raw_path.exists() or not meta_path.exists():
+        return {}
+    try:
+        return json.loads(meta_path.read_text())
+    except ValueError:
+        return {}
+
+
+def save_validators(cache_dir, url, validators):
+    # Only called once the outputs are written, so a failed run is retried
+    # in full next time instead of being answered with 304s
+    _, meta_path = cache_paths(cache_dir, url)
+    meta_path.write_text(json.dumps(validators))
+
+
+def fetch_to_cache(cache_dir, url, response):
+    # Spool the body straight to the cache as it arrives; it is parsed from
+    # there by a worker process once complete. A file is therefore no longer
+    # parsed while it is still downloading. The overlap is now between
+    # registries: one is parsed in another process while the others download.
+    raw_path, _ = cache_paths(cache_dir, url)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = raw_path.with_name(raw_path.name + ".tmp")
+    size = 0
+    with open(tmp_path, "wb") as raw_file:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            raw_file.write(chunk)
+            size += len(chunk)
+    os.replace(tmp_path, raw_path)
+    return raw_path, size
+
+
+def new_stage():
+    return {"wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes": None, "records": 0, "tracemalloc_peak": None}
+
+
+@contextmanager
+def stage(name):
+    # Time a stage of the run. The body adds its bytes and record or file
+    # counts to the yielded entry. CPU time is this process's only, and the memory
+    # peak is only known when tracemalloc is running.
+    entry = stages.setdefault(name, new_stage())
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield entry
+    finally:
+        entry["wall_seconds"] += time.perf_counter() - wall
+        entry["cpu_seconds"] += time.process_time() - cpu
+        if tracemalloc.is_tracing():
+            entry["tracemalloc_peak"] = max(entry["tracemalloc_peak"] or 0, tracemalloc.get_traced_memory()[1])
+
 
-countries = defaultdict(list)
+def open_registry_file(path):
+    with open(path, "rb") as f:
+        magic = f.read(3)
+    opener = next((opener for prefix, opener in COMPRESSED_FORMATS if magic.startswith(prefix)), open)
+    return opener(path, "rt", encoding="utf-8", errors="replace")
 
-for url in URLS:
+
+def parse_file(path, trace_memory=False):
+    # Runs in a worker process; streams the file line by line and hands back
+    # packed integer columns rather than Python objects, along with the
+    # worker's own measurements for the report
+    if trace_memory:
+        tracemalloc.start()
+    counts, skipped = Counter(), Counter()
+    with stage("parse") as entry:
+        with open_registry_file(path) as f:
+            packed = pack(parse((line.rstrip("\r\n") for line in f), counts, skipped))
+        entry["bytes"] = os.path.getsize(path)
+        entry["records"] = counts["records"]
+        entry["parsed"] = counts["parsed"]
+        entry["skipped"] = dict(skipped)
+    if trace_memory:
+        tracemalloc.stop()
+    return packed, stages.pop("parse")
+
+
+def registry_name(url):
+    # "delegated-arin-extended-latest" -> "arin"
+    return url.rsplit("/", 1)[-1].split("-")[1]
+
+
+def is_url(source):
+    return source.startswith(("http://", "https://"))
+
+
+def mirror_cache_dir(cache_dir, base):
+    # Each mirror gets its own cache below the live one, so a mirror's files
+    # and validators are never sent to, or reused for, the real registries
+    key = hashlib.sha256(base.rstrip("/").encode()).hexdigest()[:16]
+    return cache_dir / f"mirror-{key}"
+
+
+def mirror_urls(base, urls):
+    # The registry file names under another base URL, e.g. a local HTTP server
+    return [f"{base.rstrip('/')}/{url.rsplit('/', 1)[-1]}" for url in urls]
+
+
+def local_file(directory, url):
+    # A registry file in a local directory, optionally compressed
+    name = url.rsplit("/", 1)[-1]
+    for suffix in ("", *COMPRESSED_SUFFIXES):
+        path = directory / (name + suffix)
+        if path.is_file():
+            return path
+    print(f"No local copy of {name} in {directory}")
+    return None
+
+
+def download(session, url, cache_dir, processes, trace_memory=False):
+    # Returns (validators, parse future, download stats); validators is None
+    # when nothing new was downloaded. A fresh file is handed to the process
+    # pool as soon as it is on disk, so parsing overlaps the other downloads.
+    # Registries that did not change are only parsed if another one did.
     print(f"Downloading {url}")
+    stats = {"status": "failed", "wall_seconds": 0.0, "bytes": 0}
+    started = time.perf_counter()
+    try:
+        validators, parsed = fetch(session, url, cache_dir, processes, trace_memory, stats)
+    finally:
+        stats["wall_seconds"] = time.perf_counter() - started
+    return validators, parsed, stats
+
+
+def fetch(session, url, cache_dir, processes, trace_memory, stats):
+    validators = load_validators(cache_dir, url)
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
     try:
-        response = requests.get(url, timeout=60)
-        response.raise_for_status()
-        data = response.text
+        with session.get(url, headers=headers, timeout=60, stream=True) as response:
+            if response.status_code == 304:
+                print(f"Not modified: {url}")
+                stats["status"] = "not_modified"
+                return None, None
+            response.raise_for_status()
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            raw_path, stats["bytes"] = fetch_to_cache(cache_dir, url, response)
+            stats["status"] = "downloaded"
+            return validators, processes.submit(parse_file, raw_path, trace_memory)
     except Exception as e:
         print(f"Error downloading {url}: {e}")
-        continue
+        if cache_paths(cache_dir, url)[0].exists():
+            print(f"Using cached copy of {url}")
+        return None, None
+
+
+def download_all(urls, concurrency, cache_dir, processes, trace_memory=False):
+    # Results come back in URL order, so output stays deterministic
+    with make_session(concurrency) as session:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(lambda url: download(session, url, cache_dir, processes, trace_memory), urls))
+
 
-    for line in data.splitlines():
+def range_to_cidrs(start, count, bits=32):
+    # Minimal exact set of (network, prefix) blocks covering [start, start + count)
+    end = start + count
+    while start < end:
+        # Largest block aligned at start that does not run past the end
+        size = start & -start if start else 1 << bits
+        size = min(size, 1 << ((end - start).bit_length() - 1))
+        yield start, bits - (size.bit_length() - 1)
+        start += size
+
+
+def parse(lines, counts=None, skipped=None):
+    # Records are kept as (version, network, prefix) integer tuples from here
+    # on; turning them into CIDR text is left to the write stage. Lines read
+    # and parsed go into counts, lines dropped into skipped by reason.
+    if counts is None:
+        counts = Counter()
+    if skipped is None:
+        skipped = Counter()
+    countries = defaultdict(list)
+    for line in lines:
+        counts["records"] += 1
         if line.startswith("#"):
+            skipped["comment"] += 1
             continue
 
         parts = line.split("|")
         if len(parts) < 7:
+            skipped["summary" if parts[-1] == "summary" else "malformed"] += 1
             continue
 
         _, cc, rtype, start, value, _, status = parts[:7]  # Take only first 7 to avoid unpack errors
         if status not in ("allocated", "assigned"):
+            # The version line is the only one that starts with a number,
+            # "2" or "2.3" for ARIN's extended format
+            skipped["header" if parts[0].replace(".", "", 1).isdigit() else "status"] += 1
             continue
         if cc == "" or cc == "ZZ":
+            skipped["no_country"] += 1
             continue
 
         try:
             if rtype == "ipv4":
-                value_int = int(value)
-                if value_int == 0:
+                count = int(value)
+                if count == 0:
+                    skipped["empty"] += 1
                     continue
-                prefix = 32 - (value_int.bit_length() - 1)
-                net = ipaddress.ip_network(f"{start}/{prefix}", strict=False)
+                first = int.from_bytes(socket.inet_pton(socket.AF_INET, start), "big")
+                if not 0 < count <= (1 << 32) - first:
+                    raise ValueError(f"invalid address count {value}")
+                countries[cc].extend((4, network, prefix) for network, prefix in range_to_cidrs(first, count))
             elif rtype == "ipv6":
-                net = ipaddress.ip_network(f"{start}/{value}", strict=False)
+                prefix = int(value)
+                if not 0 <= prefix <= 128:
+                    raise ValueError(f"invalid prefix length {value}")
+                address = int.from_bytes(socket.inet_pton(socket.AF_INET6, start), "big")
+                countries[cc].append((6, address & ~((1 << (128 - prefix)) - 1), prefix))
             else:
+                skipped["type"] += 1
                 continue
-
-            countries[cc].append(str(net))
+            counts["parsed"] += 1
         except Exception as e:
             print(f"Error processing line '{line}': {e}")
-            pass
+            skipped["invalid"] += 1
+
+    return countries
+
+
+def new_columns():
+    # IPv4 network, IPv4 prefix, IPv6 network high and low 64 bits, IPv6 prefix
+    return array("I"), array("B"), array("Q"), array("Q"), array("B")
+
+
+def pack(countries):
+    # Per-country integer columns, compact to send back from a worker process
+    # and cheap for the parent to merge
+    packed = {}
+    for cc, records in countries.items():
+        v4_network, v4_prefix, v6_high, v6_low, v6_prefix = columns = new_columns()
+        for version, network, prefix in records:
+            if version == 4:
+                v4_network.append(network)
+                v4_prefix.append(prefix)
+            else:
+                v6_high.append(network >> 64)
+                v6_low.append(network & LOW_64)
+                v6_prefix.append(prefix)
+        packed[cc] = columns
+    return packed
+
+
+def merge_intervals(intervals):
+    # Linear sweep over half-open [start, end) intervals, already sorted by
+    # start, that folds overlapping, nested and directly adjacent ones together
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def aggregate(countries):
+    # Dedupe and sort each country's packed records once as integer tuples,
+    # then collapse them per address family into the fewest intervals
+    aggregated = {}
+    for cc in sorted(countries):
+        v4_network, v4_prefix, v6_high, v6_low, v6_prefix = countries[cc]
+        v4 = ((network, network + (1 << (32 - prefix))) for network, prefix in sorted(set(zip(v4_network, v4_prefix))))
+        v6 = (
+            (high << 64 | low, (high << 64 | low) + (1 << (128 - prefix)))
+            for high, low, prefix in sorted(set(zip(v6_high, v6_low, v6_prefix)))
+        )
+        aggregated[cc] = merge_intervals(v4), merge_intervals(v6)
+    return aggregated
+
+
+def interval_cidrs(intervals, bits):
+    for start, end in intervals:
+        yield from range_to_cidrs(start, end - start, bits)
+
+
+def format_address(version, value):
+    if version == 4:
+        return socket.inet_ntoa(value.to_bytes(4, "big"))
+    return str(ipaddress.IPv6Address(value))
+
+
+def render_cidrs(countries):
+    # CIDR text per country and family, shared by every text output
+    rendered = {}
+    for cc, families in countries.items():
+        rendered[cc] = tuple(
+            [f"{format_address(version, network)}/{prefix}" for network, prefix in interval_cidrs(intervals, ADDRESS_BITS[version])]
+            for version, intervals in zip((4, 6), families)
+        )
+    return rendered
+
+
+def content_digest(data):
+    return hashlib.sha256(data).digest()
+
+
+def replace_file(path, data):
+    # Replace the file through a temporary one so readers (and processes
+    # that have the old file mapped) never see a partial write
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_file(path, data, digest=content_digest):
+    # Leave files whose content is unchanged untouched, mtime included
+    if isinstance(data, str):
+        data = data.encode()
+    try:
+        if path.stat().st_size == len(data) or digest is not content_digest:
+            if digest(path.read_bytes()) == digest(data):
+                file_writes["unchanged"] += 1
+                return False
+    except FileNotFoundError:
+        pass
+
+    replace_file(path, data)
+    file_writes["changed"] += 1
+    file_writes["bytes"] += len(data)
+    return True
+
+
+def remove_stale(directory, pattern, kept):
+    # Delete files an earlier run generated that this run did not, such as
+    # the IPv6 list of a country that no longer has IPv6 blocks
+    for stale in directory.glob(pattern):
+        if stale not in kept:
+            stale.unlink()
+            file_writes["changed"] += 1
+
+
+def write(cidrs):
+    # Per-family files plus the combined country/ files, all from one pass
+    kept = set()
+    for cc, (v4, v6) in cidrs.items():
+        name = f"{cc.lower()}.txt"
+        v4_text = "".join(n + "\n" for n in v4)
+        v6_text = "".join(n + "\n" for n in v6)
+        write_file(OUT_DIR / name, v4_text + v6_text)
+        kept.add(OUT_DIR / name)
+        if v4_text:
+            write_file(IPV4_DIR / name, v4_text)
+            kept.add(IPV4_DIR / name)
+        if v6_text:
+            write_file(IPV6_DIR / name, v6_text)
+            kept.add(IPV6_DIR / name)
+    # A country that dropped out of the data loses its lists too; otherwise
+    # read_previous() would report it as removed again on every run
+    remove_stale(OUT_DIR, "*.txt", kept)
+    remove_stale(IPV4_DIR, "*.txt", kept)
+    remove_stale(IPV6_DIR, "*.txt", kept)
+
+
+def read_previous():
+    # The combined lists from the last run, before they are overwritten
+    return {file.stem: file.read_text().split() for file in OUT_DIR.glob("*.txt")}
+
+
+def write_delta(previous, cidrs):
+    # Per-country CIDRs added and removed since the last run. Applying the
+    # additions before the removals never leaves an address uncovered.
+    current = {cc.lower(): v4 + v6 for cc, (v4, v6) in cidrs.items()}
+    changes = {}
+    kept = set()
+    for cc in sorted(set(previous) | set(current)):
+        new = current.get(cc, [])
+        old = previous.get(cc, [])
+        new_set, old_set = set(new), set(old)
+        change = {
+            "added": [n for n in new if n not in old_set],
+            "removed": [n for n in old if n not in new_set],
+        }
+        if not change["added"] and not change["removed"]:
+            continue
+        changes[cc] = change
+        for kind, nets in change.items():
+            if nets:
+                path = DELTA_DIR / f"{cc}.{kind}"
+                write_file(path, "".join(n + "\n" for n in nets))
+                kept.add(path)
+
+    # Deltas describe the latest run only
+    remove_stale(DELTA_DIR, "*.added", kept)
+    remove_stale(DELTA_DIR, "*.removed", kept)
+    write_file(DELTA_DIR / "delta.json", json.dumps({"countries": changes}, indent=2) + "\n")
+
+
+def nft_element(version, start, end):
+    # Interval sets take start-end ranges directly, no CIDR split needed
+    if end - start == 1:
+        return format_address(version, start)
+    return f"{format_address(version, start)}-{format_address(version, end - 1)}"
+
+
+def write_nftables(countries):
+    # One nft -f file per country. nft applies a file as a single transaction,
+    # so flushing and refilling the sets swaps them atomically.
+    kept = set()
+    for cc, families in countries.items():
+        name = cc.lower()
+        lines = [
+            "#!/usr/sbin/nft -f",
+            f"# {cc} address blocks, generated by scripts/update_country_ip.py",
+            "",
+            f"table inet {NFT_TABLE} {{",
+        ]
+        for version in (4, 6):
+            lines += [
+                f"\tset {name}_v{version} {{",
+                f"\t\ttype ipv{version}_addr",
+                "\t\tflags interval",
+                "\t\tauto-merge",
+                "\t}",
+            ]
+        lines += ["}", ""]
+        for version in (4, 6):
+            lines.append(f"flush set inet {NFT_TABLE} {name}_v{version}")
+        for version, intervals in zip((4, 6), families):
+            if not intervals:
+                continue
+            elements = ",\n".join(f"\t{nft_element(version, start, end)}" for start, end in intervals)
+            lines += ["", f"add element inet {NFT_TABLE} {name}_v{version} {{", elements, "}"]
+        write_file(NFT_DIR / f"{name}.nft", "\n".join(lines) + "\n")
+        kept.add(NFT_DIR / f"{name}.nft")
+    remove_stale(NFT_DIR, "*.nft", kept)
+
+
+def ipset_sizes(count):
+    # One hash bucket per entry so restoring never triggers a resize, and
+    # never below ipset's own defaults
+    hashsize = max(1024, 1 << max(count - 1, 0).bit_length())
+    return hashsize, max(65536, hashsize * 2)
+
+
+def write_ipset(cidrs):
+    # ipset restore files that build <cc>_v4-new / <cc>_v6-new; the live set
+    # is then replaced with swap (see scripts/ipset-refresh.sh)
+    kept = set()
+    for cc, families in cidrs.items():
+        for version, nets in zip((4, 6), families):
+            if not nets:
+                continue
+            name = f"{cc.lower()}_v{version}"
+            hashsize, maxelem = ipset_sizes(len(nets))
+            family = "inet" if version == 4 else "inet6"
+            lines = [f"create {name}-new hash:net family {family} hashsize {hashsize} maxelem {maxelem}"]
+            lines += [f"add {name}-new {n}" for n in nets]
+            write_file(IPSET_DIR / f"{name}.restore", "\n".join(lines) + "\n")
+            kept.add(IPSET_DIR / f"{name}.restore")
+    remove_stale(IPSET_DIR, "*.restore", kept)
+
+
+def write_iptables(cidrs):
+    # iptables-restore / ip6tables-restore files with one chain per country.
+    # Declaring the chain flushes it under --noflush, so the whole country is
+    # replaced in a single commit.
+    kept = set()
+    for cc, families in cidrs.items():
+        chain = f"{IPTABLES_CHAIN_PREFIX}{cc.upper()}"
+        for version, nets in zip((4, 6), families):
+            if not nets:
+                continue
+            tool = "iptables-restore" if version == 4 else "ip6tables-restore"
+            lines = [
+                f"# {cc} IPv{version} blocks for {tool} --noflush, generated by scripts/update_country_ip.py",
+                "*filter",
+                f":{chain} - [0:0]",
+            ]
+            lines += [f"-A {chain} -s {n} -j {IPTABLES_TARGET}" for n in nets]
+            lines.append("COMMIT")
+            path = IPTABLES_DIR / f"{cc.lower()}_v{version}.rules"
+            write_file(path, "\n".join(lines) + "\n")
+            kept.add(path)
+    remove_stale(IPTABLES_DIR, "*.rules", kept)
+
+
+def flat_cidrs(codes, version, ranges):
+    # (CIDR text, country) for flattened ranges, in address order
+    for start, end, i in ranges:
+        for network, prefix in range_to_cidrs(start, end - start + 1, ADDRESS_BITS[version]):
+            yield f"{format_address(version, network)}/{prefix}", codes[i]
+
+
+def write_nginx_geo(flat, path, ranges=False):
+    # A single geo block for every country, built from the flattened ranges so
+    # nginx sees no overlaps. nginx only supports IPv4 in ranges mode, so
+    # there IPv6 gets its own CIDR geo block and a map joins the two.
+    codes, v4, v6 = flat
+
+    def cidr_entries(version, family):
+        for cidr, cc in flat_cidrs(codes, version, family):
+            yield f"    {cidr} {cc};"
+
+    lines = ["# Country of the client address, generated by scripts/update_country_ip.py"]
+    if ranges:
+        lines += ["geo $country_ipv4 {", "    ranges;", '    default "";']
+        lines += [f"    {format_address(4, start)}-{format_address(4, end)} {codes[i]};" for start, end, i in v4]
+        lines += ["}", "", "geo $country_ipv6 {", '    default "";']
+        lines += cidr_entries(6, v6)
+        lines += ["}", "", "map $country_ipv4 $country {", '    "" $country_ipv6;', "    default $country_ipv4;", "}"]
+    else:
+        lines += ["geo $country {", '    default "";']
+        lines += cidr_entries(4, v4)
+        lines += cidr_entries(6, v6)
+        lines.append("}")
+
+    write_file(path, "\n".join(lines) + "\n")
+
+
+def write_haproxy_map(flat, path):
+    # "<cidr> <country>" lines for map_ip; entries never overlap, so the map
+    # can be replaced wholesale over the runtime API
+    codes, v4, v6 = flat
+    lines = [f"{cidr} {cc}\n" for version, ranges in ((4, v4), (6, v6)) for cidr, cc in flat_cidrs(codes, version, ranges)]
+    write_file(path, "".join(lines))
+
+
+def snapshot_section(data):
+    if isinstance(data, array) and sys.byteorder != "little":
+        data.byteswap()
+    raw = bytes(data)
+    return raw + b"\0" * (-len(raw) % 8)
+
+
+def flatten(countries):
+    # One sorted, non-overlapping (start, inclusive end, country index) list
+    # per family across all countries, for the lookup databases
+    codes = list(countries)
+    v4 = disjoint_ranges((start, end - 1, i) for i, cc in enumerate(codes) for start, end in countries[cc][0])
+    v6 = disjoint_ranges((start, end - 1, i) for i, cc in enumerate(codes) for start, end in countries[cc][1])
+    return codes, v4, v6
+
+
+def write_snapshot(flat, path):
+    codes, v4, v6 = flat
+    index_type = "B" if len(codes) <= 256 else "H"
+
+    sections = [
+        SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, array(index_type).itemsize, len(codes), len(v4), len(v6), 0
+        ),
+        "".join(codes).encode("ascii"),
+        array("I", (start for start, _, _ in v4)),
+        array("I", (end for _, end, _ in v4)),
+        array(index_type, (i for _, _, i in v4)),
+        array("Q", (start >> 64 for start, _, _ in v6)),
+        array("Q", (start & LOW_64 for start, _, _ in v6)),
+        array("Q", (end >> 64 for _, end, _ in v6)),
+        array("Q", (end & LOW_64 for _, end, _ in v6)),
+        array(index_type, (i for _, _, i in v6)),
+    ]
+
+    write_file(path, b"".join(snapshot_section(section) for section in sections))
+
+
+def mmdb_digest(data):
+    # The metadata records the build time, so only the search tree and data
+    # section decide whether the database changed
+    return content_digest(data[:data.rfind(METADATA_MARKER)])
+
+
+def write_mmdb(flat, path):
+    codes, v4, v6 = flat
+    writer = MMDBWriter(
+        database_type=MMDB_DATABASE_TYPE,
+        description={"en": "Country IP blocks from Regional Internet Registry delegation data"},
+    )
+    records = [{"country": {"iso_code": cc}, "registered_country": {"iso_code": cc}} for cc in codes]
+    # IPv4 lives at ::/96 in the tree, so IPv6 ranges are clipped above it to
+    # keep the combined list free of overlaps
+    ipv4_end = 1 << 32
+    ranges = [(start, end, records[i]) for start, end, i in v4]
+    ranges += [(max(start, ipv4_end), end, records[i]) for start, end, i in v6 if end >= ipv4_end]
+    writer.insert_ranges(ranges)
+    writer.add_ipv4_aliases()
+    write_file(path, writer.to_bytes(), digest=mmdb_digest)
+
+
+def update(args):
+    # The whole run; returns "updated", "unchanged" when there was no new
+    # data, or "failed" when there was nothing to read
+    countries = defaultdict(new_columns)
+    urls = URLS
+    cache_dir = args.cache_dir
+    results = []
+
+    mp_context = multiprocessing.get_context(WORKER_START_METHOD)
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=mp_context) as processes:
+        with stage("download") as entry:
+            # Downloads and writes count files, not records
+            entry["records"] = None
+            if args.source and not is_url(args.source):
+                # Local files are always parsed in full; there is nothing to cache
+                directory = Path(args.source)
+                paths = [local_file(directory, url) for url in urls]
+                parses = [processes.submit(parse_file, path, args.trace_memory) if path else None for path in paths]
+                entry["bytes"] = sum(path.stat().st_size for path in paths if path)
+                entry["files"] = sum(path is not None for path in paths)
+            else:
+                if args.source:
+                    urls = mirror_urls(args.source, urls)
+                    cache_dir = mirror_cache_dir(cache_dir, args.source)
+                results = download_all(urls, args.concurrency, cache_dir, processes, args.trace_memory)
+                entry["bytes"] = sum(stats["bytes"] for _, _, stats in results)
+                entry["files"] = sum(stats["status"] == "downloaded" for _, _, stats in results)
+                for url, (_, _, stats) in zip(urls, results):
+                    registries[registry_name(url)] = {"url": url, "download": stats}
+                if all(validators is None for validators, _, _ in results):
+                    # Only a clean round of 304s means the data is current
+                    statuses = {stats["status"] for _, _, stats in results}
+                    if statuses != {"not_modified"}:
+                        print("Could not download every registry file, and none has new data.")
+                        return "failed"
+                    print("No registry has published new data, nothing to do.")
+                    return "unchanged"
+
+                parses = []
+                for url, (_, parsed, _) in zip(urls, results):
+                    if parsed is None:
+                        raw_path, _ = cache_paths(cache_dir, url)
+                        if raw_path.exists():
+                            parsed = processes.submit(parse_file, raw_path, args.trace_memory)
+                    parses.append(parsed)
+
+            # Without every registry the lists would lose the countries only
+            # the missing one covers, and delete their files
+            missing = [url for url, parsed in zip(urls, parses) if parsed is None]
+            if missing:
+                print(f"No data for {', '.join(missing)}, not writing partial lists.")
+                return "failed"
+
+        # Merge the workers' columns in URL order. The workers report their
+        # own parse figures; waiting on them counts towards the merge.
+        parse_entry = stages["parse"] = new_stage()
+        parse_entry["bytes"] = 0
+        with stage("merge") as entry:
+            for url, parsed in zip(urls, parses):
+                if parsed is None:
+                    continue
+                packed, worker = parsed.result()
+                registry = registries.setdefault(registry_name(url), {"url": url, "download": None})
+                registry["parsed"], registry["skipped"] = worker["parsed"], worker["skipped"]
+                for key in ("wall_seconds", "cpu_seconds", "bytes", "records"):
+                    parse_entry[key] += worker[key]
+                if worker["tracemalloc_peak"] is not None:
+                    parse_entry["tracemalloc_peak"] = max(parse_entry["tracemalloc_peak"] or 0, worker["tracemalloc_peak"])
+                for cc, columns in packed.items():
+                    entry["records"] += len(columns[0]) + len(columns[2])
+                    for merged, column in zip(countries[cc], columns):
+                        merged.extend(column)
+
+    with stage("dedupe_sort") as entry:
+        entry["records"] = sum(len(columns[0]) + len(columns[2]) for columns in countries.values())
+        aggregated = aggregate(countries)
+    with stage("conversion") as entry:
+        cidrs = render_cidrs(aggregated)
+        flat = flatten(aggregated)
+        entry["records"] = sum(len(v4) + len(v6) for v4, v6 in cidrs.values())
+        country_blocks.update((cc, (len(v4), len(v6))) for cc, (v4, v6) in cidrs.items())
+    with stage("write") as entry:
+        entry["records"] = None
+        write_delta(read_previous(), cidrs)
+        write(cidrs)
+        write_nftables(aggregated)
+        write_ipset(cidrs)
+        write_iptables(cidrs)
+        write_snapshot(flat, SNAPSHOT_PATH)
+        write_mmdb(flat, MMDB_PATH)
+        write_nginx_geo(flat, NGINX_GEO_PATH, ranges=args.nginx_ranges)
+        write_haproxy_map(flat, HAPROXY_MAP_PATH)
+        entry["bytes"] = file_writes["bytes"]
+        entry["files"] = file_writes["changed"] + file_writes["unchanged"]
+
+    for url, (validators, _, _) in zip(urls, results):
+        if validators is not None:
+            save_validators(cache_dir, url, validators)
+
+    print(f"Done. {file_writes['changed']} files changed, {file_writes['unchanged']} unchanged.")
+    return "updated"
+
+
+def write_report(path, report):
+    replace_file(path, (json.dumps(report, indent=2) + "\n").encode())
+
+
+def metric_sample(name, value, **labels):
+    label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels.items())
+    return f"{METRICS_PREFIX}_{name}{{{label_text}}} {value}" if labels else f"{METRICS_PREFIX}_{name} {value}"
+
+
+def previous_samples(path):
+    # Sample lines from an earlier metrics file, by metric name
+    samples = defaultdict(list)
+    try:
+        lines = path.read_text().splitlines()
+    except FileNotFoundError:
+        return samples
+    for line in lines:
+        if line and not line.startswith("#"):
+            samples[line.split("{", 1)[0].split(" ", 1)[0]].append(line)
+    return samples
+
+
+def write_metrics(path, report, finished):
+    # Prometheus text format for node_exporter's textfile collector. Data
+    # metrics from a run that parsed nothing, and the last success time of a
+    # failed run, are carried over from the previous file so the series
+    # don't disappear in between.
+    previous = previous_samples(path)
+    succeeded = report["status"] != "failed"
+    parsed = [(name, registry) for name, registry in registries.items() if "parsed" in registry]
+    downloaded = [(name, registry["download"]) for name, registry in registries.items() if registry["download"]]
+
+    metrics = [
+        ("run_duration_seconds", "Wall time of the last run.", [metric_sample("run_duration_seconds", report["wall_seconds"])]),
+        ("run_success", "Whether the last run succeeded.", [metric_sample("run_success", int(succeeded))]),
+        ("last_run_timestamp_seconds", "When the last run finished.", [metric_sample("last_run_timestamp_seconds", finished)]),
+        (
+            "last_success_timestamp_seconds",
+            "When the last successful run finished.",
+            [metric_sample("last_success_timestamp_seconds", finished)] if succeeded else None,
+        ),
+        (
+            "stage_duration_seconds",
+            "Wall time of each stage of the last run.",
+            [metric_sample("stage_duration_seconds", entry["wall_seconds"], stage=name) for name, entry in report["stages"].items()],
+        ),
+        (
+            "download_duration_seconds",
+            "Time taken to download each registry file.",
+            [metric_sample("download_duration_seconds", stats["wall_seconds"], registry=name) for name, stats in downloaded],
+        ),
+        (
+            "download_bytes",
+            "Bytes downloaded per registry; 0 when the file was not modified.",
+            [metric_sample("download_bytes", stats["bytes"], registry=name) for name, stats in downloaded],
+        ),
+        (
+            "records_parsed",
+            "Registry records turned into address blocks.",
+            [metric_sample("records_parsed", registry["parsed"], registry=name) for name, registry in parsed] or None,
+        ),
+        (
+            "records_skipped",
+            "Registry lines skipped, by reason.",
+            [
+                metric_sample("records_skipped", count, registry=name, reason=reason)
+                for name, registry in parsed
+                for reason, count in sorted(registry["skipped"].items())
+            ]
+            or None,
+        ),
+        (
+            "country_blocks",
+            "CIDR blocks per country and address family.",
+            [
+                metric_sample("country_blocks", count, country=cc, family=family)
+                for cc, counts in sorted(country_blocks.items())
+                for family, count in zip(("ipv4", "ipv6"), counts)
+            ]
+            or None,
+        ),
+    ]
+
+    lines = []
+    for name, help_text, samples in metrics:
+        if samples is None:
+            samples = previous[f"{METRICS_PREFIX}_{name}"]
+        if samples:
+            lines += [f"# HELP {METRICS_PREFIX}_{name} {help_text}", f"# TYPE {METRICS_PREFIX}_{name} gauge", *samples]
+
+    # The collector may read at any time, so replace the file in one step
+    replace_file(path, ("\n".join(lines) + "\n").encode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate per-country IP block lists from RIR delegated files.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"maximum number of registries downloaded at once (default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"worker processes used to parse registry files (default: {DEFAULT_JOBS})",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=CACHE_DIR,
+        help=f"where raw delegated files and their ETag/Last-Modified are kept (default: {CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--source",
+        help="read the registry files from this directory (plain, .gz or .bz2) or base URL instead of the RIRs",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=REPORT_PATH,
+        help=f"where the JSON report with per-stage timings is written (default: {REPORT_PATH})",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="record each stage's tracemalloc peak in the report; makes parsing several times slower",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="write Prometheus metrics for node_exporter's textfile collector to this .prom file",
+    )
+    parser.add_argument(
+        "--nginx-ranges",
+        action="store_true",
+        help="write the nginx geo block in ranges mode (merged start-end ranges instead of CIDRs)",
+    )
+    args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.source and not is_url(args.source) and not Path(args.source).is_dir():
+        parser.error(f"--source {args.source} is neither a directory nor an http(s) URL")
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = datetime.now(timezone.utc)
+    wall, cpu = time.perf_counter(), time.process_time()
+    status = "failed"
+    try:
+        status = update(args)
+    finally:
+        # Worker processes are reaped by now, so their CPU time shows up in
+        # the children's times
+        times = os.times()
+        report = {
+            "started": started.isoformat(timespec="seconds"),
+            "status": status,
+            "wall_seconds": time.perf_counter() - wall,
+            "cpu_seconds": time.process_time() - cpu,
+            "children_cpu_seconds": times.children_user + times.children_system,
+            "tracemalloc": args.trace_memory,
+            "stages": stages,
+            "registries": registries,
+            "files": {"changed": file_writes["changed"], "unchanged": file_writes["unchanged"]},
+        }
+        write_report(args.report, report)
+        if args.metrics_file:
+            write_metrics(args.metrics_file, report, time.time())
+    if status == "failed":
+        sys.exit(1)
 
-# Write files
-for cc, nets in sorted(countries.items()):
-    unique_nets = sorted(set(nets), key=lambda x: (ipaddress.ip_network(x).version, ipaddress.ip_network(x)))
-    with open(OUT_DIR / f"{cc.lower()}.txt", "w") as f:
-        for n in unique_nets:
-            f.write(n + "\n")
 
-print("Done.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import ipaddress
+import random
+
+import pytest
+
+from country_lookup import CountryLookup, disjoint_ranges
+from update_country_ip import write_mmdb, write_snapshot
+
+CODES = ["AU", "CN", "DE", "JP", "US"]
+
+
+def random_flat(seed):
+    # Overlapping random ranges per family, flattened the way the updater
+    # does before writing either database
+    rng = random.Random(seed)
+    families = []
+    for bits, base in ((32, 0), (128, 0x2000 << 112)):
+        ranges = []
+        for _ in range(300):
+            size = 1 << rng.randint(0, 24 if bits == 32 else 80)
+            start = base + rng.getrandbits(bits - 4) // size * size
+            ranges.append((start, start + size * rng.randint(1, 3) - 1, rng.randrange(len(CODES))))
+        families.append(disjoint_ranges(ranges))
+    return CODES, families[0], families[1]
+
+
+def probe_addresses(flat, seed):
+    # Both ends of every range, the addresses just outside them and random ones
+    rng = random.Random(seed)
+    _, v4, v6 = flat
+    for bits, address, ranges in ((32, ipaddress.IPv4Address, v4), (128, ipaddress.IPv6Address, v6)):
+        values = {value for start, end, _ in ranges for value in (start - 1, start, end, end + 1)}
+        values.update(rng.getrandbits(bits) for _ in range(500))
+        yield from (address(value) for value in sorted(values) if 0 <= value < 1 << bits)
+
+
+def expected_country(flat, address):
+    codes, v4, v6 = flat
+    value = int(address)
+    for start, end, index in v4 if address.version == 4 else v6:
+        if start <= value <= end:
+            return codes[index]
+    return None
+
+
+def test_snapshot_round_trip(tmp_path):
+    flat = random_flat(0)
+    write_snapshot(flat, tmp_path / "snapshot.bin")
+    table = CountryLookup.from_snapshot(tmp_path / "snapshot.bin")
+
+    assert table.codes == CODES
+    addresses = list(probe_addresses(flat, 1))
+    for address in addresses:
+        assert table.lookup(str(address)) == expected_country(flat, address)
+
+
+def test_snapshot_batch_lookups_match_single(tmp_path):
+    pytest.importorskip("numpy")
+    flat = random_flat(2)
+    write_snapshot(flat, tmp_path / "snapshot.bin")
+    table = CountryLookup.from_snapshot(tmp_path / "snapshot.bin")
+
+    addresses = list(probe_addresses(flat, 3))
+    v4 = [str(address) for address in addresses if address.version == 4]
+    v6 = [str(address) for address in addresses if address.version == 6]
+    assert list(table.lookup_ipv4_batch(v4)) == [table.lookup(address) or "" for address in v4]
+    assert list(table.lookup_ipv6_batch(v6)) == [table.lookup(address) or "" for address in v6]
+
+
+def test_mmdb_round_trip(tmp_path):
+    maxminddb = pytest.importorskip("maxminddb")
+    flat = random_flat(4)
+    write_mmdb(flat, tmp_path / "country.mmdb")
+
+    with maxminddb.open_database(str(tmp_path / "country.mmdb")) as reader:
+        assert reader.metadata().database_type == "GeoLite2-Country"
+        for address in probe_addresses(flat, 5):
+            record = reader.get(address)
+            expected = expected_country(flat, address)
+            if expected is None:
+                assert record is None
+            else:
+                assert record == {"country": {"iso_code": expected}, "registered_country": {"iso_code": expected}}
+                if address.version == 4:
+                    # IPv4-mapped addresses resolve through the IPv4 subtree
+                    assert reader.get(f"::ffff:{address}") == record
@@ -0,0 +1,33 @@
+import pytest
+
+from country_lookup import ipv4_array, parse_address
+
+np = pytest.importorskip("numpy")
+
+IPV4_INPUTS = [
+    "1.2.3.4",
+    "0.0.0.0",
+    "255.255.255.255",
+    " 1.2.3.4",
+    "1.2.3.4\n",
+    "01.2.3.4",
+    "1.2.3.00",
+    "1.2.3.+4",
+    "1.2.3.-4",
+    "1..2.3",
+    "1.2.3.4.",
+    "1.2.3",
+    "1.2.3.256",
+    "1.2.3.4 junk",
+]
+
+
+@pytest.mark.parametrize("address", IPV4_INPUTS)
+def test_ipv4_batch_accepts_what_single_lookups_accept(address):
+    try:
+        expected = parse_address(address)[1]
+    except ValueError:
+        with pytest.raises(ValueError):
+            ipv4_array([address, "1.2.3.4"])
+    else:
+        assert ipv4_array([address, "1.2.3.4"]).tolist() == [expected, 0x01020304]
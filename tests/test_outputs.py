@@ -0,0 +1,86 @@
+import json
+import os
+from collections import Counter
+
+import pytest
+
+import update_country_ip
+from mmdb_writer import MMDBWriter
+from update_country_ip import mmdb_digest, read_previous, write, write_delta, write_file
+
+
+@pytest.fixture(autouse=True)
+def work(tmp_path, monkeypatch):
+    # The writers use paths relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(update_country_ip, "file_writes", Counter())
+    return tmp_path
+
+
+def test_write_file_leaves_unchanged_files_untouched(work):
+    path = work / "out" / "us.txt"
+    assert write_file(path, "1.0.0.0/24\n")
+    os.utime(path, ns=(1, 1))
+
+    assert not write_file(path, "1.0.0.0/24\n")
+    assert path.stat().st_mtime_ns == 1
+
+    assert write_file(path, "1.0.1.0/24\n")
+    assert path.read_text() == "1.0.1.0/24\n"
+    assert not list(path.parent.glob("*.tmp"))
+
+
+def mmdb(networks, build_epoch):
+    writer = MMDBWriter("GeoLite2-Country", {"en": "test"})
+    for network, cc in networks:
+        writer.insert(4, network, 24, {"country": {"iso_code": cc}})
+    return writer.to_bytes(build_epoch=build_epoch)
+
+
+def test_mmdb_compare_ignores_the_build_time(work):
+    path = work / "country.mmdb"
+    first = mmdb([(0x01000000, "AU")], build_epoch=1)
+    assert write_file(path, first, digest=mmdb_digest)
+
+    assert not write_file(path, mmdb([(0x01000000, "AU")], build_epoch=2), digest=mmdb_digest)
+    assert path.read_bytes() == first
+
+    assert write_file(path, mmdb([(0x01000000, "CN")], build_epoch=3), digest=mmdb_digest)
+
+
+def test_delta_lists_added_and_removed_blocks(work):
+    previous = {"us": ["8.8.8.0/24", "9.9.9.0/24"], "ab": ["5.5.5.0/24"]}
+    cidrs = {"US": (["8.8.8.0/24", "8.8.4.0/24"], []), "CN": (["1.0.1.0/24"], ["2400::/32"])}
+    write_delta(previous, cidrs)
+
+    delta = work / "delta"
+    assert (delta / "us.added").read_text() == "8.8.4.0/24\n"
+    assert (delta / "us.removed").read_text() == "9.9.9.0/24\n"
+    assert (delta / "cn.added").read_text() == "1.0.1.0/24\n2400::/32\n"
+    assert not (delta / "cn.removed").exists()
+    # A country that disappeared has everything removed
+    assert (delta / "ab.removed").read_text() == "5.5.5.0/24\n"
+    assert json.loads((delta / "delta.json").read_text())["countries"] == {
+        "ab": {"added": [], "removed": ["5.5.5.0/24"]},
+        "cn": {"added": ["1.0.1.0/24", "2400::/32"], "removed": []},
+        "us": {"added": ["8.8.4.0/24"], "removed": ["9.9.9.0/24"]},
+    }
+
+    # The next run with no changes clears the per-country files
+    write_delta({"us": ["8.8.8.0/24", "8.8.4.0/24"]}, {"US": (["8.8.8.0/24", "8.8.4.0/24"], [])})
+    assert sorted(path.name for path in delta.iterdir()) == ["delta.json"]
+    assert json.loads((delta / "delta.json").read_text())["countries"] == {}
+
+
+def test_country_that_disappears_is_reported_removed_once(work):
+    write({"AB": (["5.5.5.0/24"], ["2a00::/32"]), "US": (["8.8.8.0/24"], [])})
+    cidrs = {"US": (["8.8.8.0/24"], [])}
+    write_delta(read_previous(), cidrs)
+    write(cidrs)
+    assert (work / "delta" / "ab.removed").exists()
+    assert not (work / "country" / "ab.txt").exists()
+    assert not (work / "ipv4" / "ab.txt").exists()
+    assert not (work / "ipv6" / "ab.txt").exists()
+
+    write_delta(read_previous(), cidrs)
+    assert not (work / "delta" / "ab.removed").exists()
@@ -0,0 +1,41 @@
+from collections import Counter
+
+from update_country_ip import parse
+
+LINES = [
+    "# comment",
+    "2.3|arin|20260101|5|19830101|20260101|-0500",
+    "2|ripencc|20260101|5|19830101|20260101|+0000",
+    "arin|*|ipv4|*|3|summary",
+    "arin|US|ipv4|8.8.8.0|256|20100101|allocated|extra",
+    "arin|US|ipv4|8.8.9.0|768|20100101|assigned",
+    "arin|US|ipv6|2001:4860::|32|20100101|allocated",
+    "arin|ZZ|ipv4|10.0.0.0|256|20100101|assigned",
+    "arin||ipv4|10.1.0.0|256|20100101|available",
+    "arin|US|ipv4|10.2.0.0|256|20100101|reserved",
+    "arin|US|asn|15169|1|20100101|allocated",
+    "arin|US|ipv4|01.2.3.0|256|20100101|allocated",
+    "arin|US|ipv4|1.2.3.0|0|20100101|allocated",
+    "arin|US|ipv6|2001:db8::|129|20100101|allocated",
+    "short|line",
+]
+
+
+def test_parse_counts_records_and_skip_reasons():
+    counts, skipped = Counter(), Counter()
+    countries = parse(LINES, counts, skipped)
+
+    assert counts == {"records": len(LINES), "parsed": 3}
+    assert skipped == {
+        "comment": 1,
+        "header": 2,
+        "summary": 1,
+        "no_country": 1,
+        "status": 2,
+        "type": 1,
+        "invalid": 2,
+        "empty": 1,
+        "malformed": 1,
+    }
+    # 768 addresses split into a /24 and a /23
+    assert countries["US"] == [(4, 0x08080800, 24), (4, 0x08080900, 24), (4, 0x08080A00, 23), (6, 0x20014860 << 96, 32)]
@@ -0,0 +1,72 @@
+import ipaddress
+import random
+
+from country_lookup import disjoint_ranges
+from update_country_ip import merge_intervals, range_to_cidrs
+
+
+def random_range(rng, bits):
+    start = rng.getrandbits(bits)
+    count = rng.randint(1, min(1 << rng.randint(0, bits), (1 << bits) - start))
+    return start, count
+
+
+def test_range_to_cidrs_matches_summarize_address_range():
+    rng = random.Random(0)
+    for bits, address in ((32, ipaddress.IPv4Address), (128, ipaddress.IPv6Address)):
+        for _ in range(2000):
+            start, count = random_range(rng, bits)
+            expected = ipaddress.summarize_address_range(address(start), address(start + count - 1))
+            assert list(range_to_cidrs(start, count, bits)) == [
+                (int(network.network_address), network.prefixlen) for network in expected
+            ]
+
+
+def test_range_to_cidrs_whole_space():
+    assert list(range_to_cidrs(0, 1 << 32)) == [(0, 0)]
+    assert list(range_to_cidrs(0, 1 << 128, 128)) == [(0, 0)]
+
+
+def test_merge_intervals_matches_collapse_addresses():
+    rng = random.Random(1)
+    for _ in range(500):
+        networks = []
+        for _ in range(rng.randint(1, 30)):
+            prefix = rng.randint(20, 32)
+            networks.append(ipaddress.IPv4Network((rng.getrandbits(12) << 20 & ~((1 << (32 - prefix)) - 1), prefix)))
+        intervals = sorted((int(n.network_address), int(n.broadcast_address) + 1) for n in networks)
+        merged = merge_intervals(intervals)
+
+        collapsed = [int(n.network_address) for n in ipaddress.collapse_addresses(networks)]
+        cidrs = [network for start, end in merged for network, _ in range_to_cidrs(start, end - start)]
+        assert cidrs == collapsed
+        # Fully merged: no two intervals overlap or touch
+        assert all(previous[1] < current[0] for previous, current in zip(merged, merged[1:]))
+
+
+def brute_force_owner(ranges, address):
+    # The narrowest covering range wins, as in a longest-prefix match
+    covering = [(end - start, end, index) for start, end, index in ranges if start <= address <= end]
+    return min(covering)[2] if covering else None
+
+
+def test_disjoint_ranges_matches_brute_force():
+    rng = random.Random(2)
+    for _ in range(1000):
+        ranges = []
+        for _ in range(rng.randint(0, 8)):
+            start = rng.randint(0, 63)
+            ranges.append((start, rng.randint(start, 63), rng.randint(0, 3)))
+        flat = disjoint_ranges(ranges)
+
+        owners = {}
+        for start, end, index in flat:
+            for address in range(start, end + 1):
+                assert address not in owners
+                owners[address] = index
+        for address in range(64):
+            assert owners.get(address) == brute_force_owner(ranges, address)
+
+        assert flat == sorted(flat)
+        # Adjacent ranges of the same country are joined
+        assert not any(a[2] == b[2] and a[1] + 1 == b[0] for a, b in zip(flat, flat[1:]))
@@ -0,0 +1,198 @@
+import functools
+import os
+import json
+import threading
+from collections import Counter
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import update_country_ip
+
+# One country per registry, so a missing registry shows up as a missing country
+REGISTRIES = {
+    "delegated-arin-extended-latest": ("arin", "US", "8.8.8.0", "2001:4860::"),
+    "delegated-ripencc-latest": ("ripencc", "DE", "5.1.0.0", "2a00:1450::"),
+    "delegated-apnic-latest": ("apnic", "JP", "1.0.16.0", "2001:200::"),
+    "delegated-afrinic-latest": ("afrinic", "ZA", "41.0.0.0", "2c0f:f000::"),
+    "delegated-lacnic-latest": ("lacnic", "BR", "177.0.0.0", "2804::"),
+}
+
+
+def write_registries(directory, names=REGISTRIES):
+    directory.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        registry, cc, v4, v6 = REGISTRIES[name]
+        lines = [
+            f"2|{registry}|20260101|2|19830101|20260101|+0000",
+            f"{registry}|*|ipv4|*|1|summary",
+            f"{registry}|{cc}|ipv4|{v4}|768|20100101|allocated",
+            f"{registry}|{cc}|ipv6|{v6}|32|20100101|assigned",
+        ]
+        (directory / name).write_text("\n".join(lines) + "\n")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    # Serves tmp_path/served over HTTP; answers If-Modified-Since with 304
+    served = tmp_path / "served"
+    served.mkdir()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(served)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield served, f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    # Runs the updater in tmp_path/work and returns its report
+    work = tmp_path / "work"
+    work.mkdir()
+    monkeypatch.chdir(work)
+
+    def run(*args):
+        for name, value in (("file_writes", Counter()), ("stages", {}), ("registries", {}), ("country_blocks", {})):
+            monkeypatch.setattr(update_country_ip, name, value)
+        monkeypatch.setattr("sys.argv", ["update_country_ip.py", "--jobs", "2", *args])
+        try:
+            update_country_ip.main()
+        except SystemExit as e:
+            assert e.code == 1
+        return json.loads((work / update_country_ip.REPORT_PATH).read_text())
+
+    return run
+
+
+def country_files(work):
+    return sorted(path.name for path in (work / "country").glob("*.txt"))
+
+
+def test_missing_registry_fails_without_touching_outputs(server, run, tmp_path):
+    served, base = server
+    write_registries(served)
+    assert run("--source", base)["status"] == "updated"
+    assert country_files(tmp_path / "work") == ["br.txt", "de.txt", "jp.txt", "us.txt", "za.txt"]
+
+    # One registry is gone and a fresh cache has no copy of it
+    (served / "delegated-apnic-latest").unlink()
+    (served / "delegated-arin-extended-latest").touch()
+    report = run("--source", base, "--cache-dir", str(tmp_path / "empty-cache"))
+    assert report["status"] == "failed"
+    assert report["registries"]["apnic"]["download"]["status"] == "failed"
+    assert country_files(tmp_path / "work") == ["br.txt", "de.txt", "jp.txt", "us.txt", "za.txt"]
+    assert not (tmp_path / "work" / "delta" / "jp.removed").exists()
+
+
+def test_local_directory_missing_a_registry_fails(run, tmp_path):
+    source = tmp_path / "snapshot"
+    write_registries(source)
+    assert run("--source", str(source))["status"] == "updated"
+
+    (source / "delegated-lacnic-latest").unlink()
+    assert run("--source", str(source))["status"] == "failed"
+    assert "br.txt" in country_files(tmp_path / "work")
+    assert not (tmp_path / "work" / "delta" / "br.removed").exists()
+
+
+def statuses(report):
+    return {name: registry["download"]["status"] for name, registry in report["registries"].items()}
+
+
+def make_newer(path):
+    # Last-Modified has one-second resolution
+    stat = path.stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+
+def test_unmodified_registries_are_answered_with_304(server, run, tmp_path):
+    served, base = server
+    write_registries(served)
+    report = run("--source", base)
+    assert report["status"] == "updated"
+    assert set(statuses(report).values()) == {"downloaded"}
+    assert report["stages"]["download"]["files"] == 5
+    assert report["stages"]["download"]["records"] is None
+    assert report["stages"]["parse"]["records"] == 20
+
+    before = {path: path.stat().st_mtime_ns for path in (tmp_path / "work" / "country").iterdir()}
+    report = run("--source", base)
+    assert report["status"] == "unchanged"
+    assert set(statuses(report).values()) == {"not_modified"}
+    assert {path: path.stat().st_mtime_ns for path in (tmp_path / "work" / "country").iterdir()} == before
+
+
+def test_unchanged_registries_are_reparsed_from_the_cache(server, run, tmp_path):
+    served, base = server
+    write_registries(served)
+    run("--source", base)
+
+    make_newer(served / "delegated-ripencc-latest")
+    report = run("--source", base)
+    assert report["status"] == "updated"
+    assert statuses(report)["ripencc"] == "downloaded"
+    assert statuses(report)["arin"] == "not_modified"
+    # Every registry was parsed, so no country went missing
+    assert all(registry["parsed"] == 2 for registry in report["registries"].values())
+    assert country_files(tmp_path / "work") == ["br.txt", "de.txt", "jp.txt", "us.txt", "za.txt"]
+
+
+def test_failed_download_falls_back_to_the_cached_copy(server, run, tmp_path):
+    served, base = server
+    write_registries(served)
+    run("--source", base)
+
+    (served / "delegated-afrinic-latest").unlink()
+    make_newer(served / "delegated-ripencc-latest")
+    report = run("--source", base)
+    assert report["status"] == "updated"
+    assert statuses(report)["afrinic"] == "failed"
+    assert report["registries"]["afrinic"]["parsed"] == 2
+    assert "za.txt" in country_files(tmp_path / "work")
+
+
+def test_failures_without_new_data_fail_the_run(server, run):
+    served, base = server
+    write_registries(served)
+    run("--source", base)
+
+    # The rest answer 304, but one registry could not be checked at all
+    (served / "delegated-afrinic-latest").unlink()
+    assert run("--source", base)["status"] == "failed"
+
+
+def test_every_download_failing_fails_the_run(server, run):
+    _, base = server
+    report = run("--source", base)
+    assert report["status"] == "failed"
+    assert set(statuses(report).values()) == {"failed"}
+
+
+def test_validators_are_only_saved_after_a_successful_run(server, run, tmp_path):
+    served, base = server
+    write_registries(served)
+    run("--source", base)
+    cache = update_country_ip.mirror_cache_dir(update_country_ip.CACHE_DIR, base)
+    _, meta_path = update_country_ip.cache_paths(cache, "delegated-ripencc-latest")
+    saved = json.loads(meta_path.read_text())
+    assert saved["last_modified"]
+
+    # ripencc has new data, but the run fails on apnic, which has no cached copy
+    make_newer(served / "delegated-ripencc-latest")
+    (served / "delegated-apnic-latest").unlink()
+    (tmp_path / "work" / cache / "delegated-apnic-latest").unlink()
+    assert run("--source", base)["status"] == "failed"
+    assert json.loads(meta_path.read_text()) == saved
+
+    # So the next run downloads ripencc again instead of getting a 304
+    write_registries(served, ["delegated-apnic-latest"])
+    report = run("--source", base)
+    assert report["status"] == "updated"
+    assert statuses(report)["ripencc"] == "downloaded"
+    assert json.loads(meta_path.read_text()) != saved